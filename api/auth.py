@@ -1,4 +1,5 @@
 from fastapi import APIRouter, Depends, HTTPException, status
+from sqlalchemy import select
 from sqlalchemy.orm import Session
 from datetime import datetime, timedelta
 
@@ -47,29 +48,35 @@ def verify_auth(request: schemas.AuthVerifyRequest, db: Session = Depends(get_db
     Creates the user if they don't exist.
     """
     # Simplified flow: since any code is valid, we just find or create the user.
-    user = db.query(models.User).filter(models.User.email == request.email).first()
-    
-    is_new = False
-    if not user:
-        is_new = True
-        user = models.User(email=request.email)
-        db.add(user)
-        db.commit()
-        db.refresh(user)
+    # A single Core query returns the user's id and existing API key (if any),
+    # without materializing ORM objects.
+    row = db.execute(
+        select(models.User.id, models.ApiKey.key)
+        .outerjoin(models.ApiKey, models.ApiKey.user_id == models.User.id)
+        .where(models.User.email == request.email)
+        .limit(1)
+    ).first()
 
-    # Check if user has an API key, if not, create one
-    if not user.api_keys:
+    is_new = row is None
+    if row is not None and row.key is not None:
+        api_key_to_return = row.key
+    else:
+        # Create the user and/or their API key in a single transaction
         api_key_str = security.generate_api_key()
-        new_api_key = models.ApiKey(key=api_key_str, user_id=user.id)
-        db.add(new_api_key)
+        if is_new:
+            user = models.User(email=request.email)
+            new_api_key = models.ApiKey(key=api_key_str, user=user)
+            db.add_all([user, new_api_key])
+        else:
+            new_api_key = models.ApiKey(key=api_key_str, user_id=row.id)
+            db.add(new_api_key)
+        # Ids are generated Python-side (uuid4) and the response only uses
+        # values we already hold, so no refresh SELECT is needed after commit
         db.commit()
-        db.refresh(new_api_key)
         api_key_to_return = api_key_str
-    else:
-        api_key_to_return = user.api_keys[0].key
 
     return schemas.AuthSuccessResponse(
-        email=user.email,
+        email=request.email,
         api_key=api_key_to_return,
         is_new_user=is_new
     )
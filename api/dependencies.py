@@ -1,5 +1,13 @@
+from typing import TYPE_CHECKING
+
+from fastapi import Request
+
 from ..db.database import SessionLocal
 
+if TYPE_CHECKING:
+    # Annotation only: importing it here would pull the indexing/model stack into auth
+    from ..services.indexing_service import IndexingService
+
 def get_db():
     """
     FastAPI dependency to provide a database session.
@@ -9,3 +17,10 @@ def get_db():
         yield db
     finally:
         db.close()
+
+
+def get_indexer(request: Request) -> "IndexingService":
+    """
+    FastAPI dependency returning the IndexingService created at startup.
+    """
+    return request.app.state.indexer
@@ -1,92 +1,190 @@
-from fastapi import APIRouter, Depends, HTTPException, status, Body, UploadFile, File, Form
+import asyncio
+import os
+import sys
+import tempfile
+import threading
+
+from cachetools import TTLCache
+from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException, status, Body, UploadFile, File, Form, Response
 
 from ..services.indexing_service import IndexingService
-from ..services.search_service import search as search_service
+from ..services.search_service import search as search_service, invalidate_semantic_cache, is_stale_cache_key
 from ..services.es_manager import clean_index as clean_service
 from ..api import schemas
-from ..auth.api_key import get_current_user
-from ..db import models
+from ..auth.api_key import AuthenticatedUser, get_current_user
+from .dependencies import get_indexer
+from ..core.config import MAX_UPLOAD_SIZE, UPLOAD_STAGING_DIR
+
+if sys.platform == "linux":
+    # Kernel async file I/O, so staging uploads to disk doesn't go through the threadpool
+    from aiofile import async_open
 
 router = APIRouter()
 
-# Initialize services
-indexing_service = IndexingService()
+UPLOAD_READ_CHUNK_SIZE = 1024 * 1024
+
+# (user_id, project_name, query, top_k) -> search results
+_search_cache = TTLCache(maxsize=2048, ttl=60)
+_search_cache_lock = threading.Lock()
+
+def _invalidate_search_cache(user_id: str, project_name: str):
+    """Drop cached search results (exact and semantic) made stale by a change to this project."""
+    with _search_cache_lock:
+        stale_keys = [key for key in _search_cache if is_stale_cache_key(key, user_id, project_name)]
+        for key in stale_keys:
+            _search_cache.pop(key, None)
+    invalidate_semantic_cache(user_id, project_name)
+
+async def _stage_upload(file: UploadFile) -> str:
+    """
+    Copy an upload to a staging file owned by the caller and return its path.
+    The request's UploadFile is closed once the response is sent,
+    before background tasks get to run.
+    """
+    fd, staged_path = tempfile.mkstemp(prefix="upload_", dir=UPLOAD_STAGING_DIR)
+    os.close(fd)
+    try:
+        if sys.platform == "linux":
+            async with async_open(staged_path, "wb") as staged:
+                while chunk := await file.read(UPLOAD_READ_CHUNK_SIZE):
+                    await staged.write(chunk)
+        else:
+            with open(staged_path, "wb") as staged:
+                while chunk := await file.read(UPLOAD_READ_CHUNK_SIZE):
+                    await asyncio.to_thread(staged.write, chunk)
+    except Exception:
+        os.remove(staged_path)
+        raise
+    return staged_path
+
+async def _index_staged_file(
+    indexing_service: IndexingService,
+    user_id: str,
+    project_name: str,
+    file_path: str,
+    staged_path: str
+):
+    """Background task: index a staged upload, then delete it."""
+    try:
+        with open(staged_path, "rb") as staged:
+            await indexing_service.index_file(
+                user_id=user_id,
+                project_name=project_name,
+                file_path=file_path,
+                file_obj=staged
+            )
+    except Exception as e:
+        print(f"Background indexing failed for {file_path}: {e}")
+    finally:
+        os.remove(staged_path)
 
 @router.post("/index", status_code=status.HTTP_202_ACCEPTED)
 def index_file(
     request: schemas.IndexRequest,
-    current_user: models.User = Depends(get_current_user)
+    background_tasks: BackgroundTasks,
+    current_user: AuthenticatedUser = Depends(get_current_user),
+    indexing_service: IndexingService = Depends(get_indexer)
 ):
     """
     Accepts file content (text/code) and metadata to be indexed.
     For text-based files like Python code.
+    Indexing runs in the background once the response has been sent.
     """
-    try:
-        indexing_service.index_file_content(
-            user_id=str(current_user.id),
-            project_name=request.project_name,
-            file_path=request.file_path,
-            file_content=request.file_content
-        )
-        return {"status": "success", "message": f"File '{request.file_path}' is being processed."}
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+    user_id = str(current_user.id)
+    _invalidate_search_cache(user_id, request.project_name)
+    background_tasks.add_task(
+        indexing_service.index_file_content,
+        user_id=user_id,
+        project_name=request.project_name,
+        file_path=request.file_path,
+        file_content=request.file_content
+    )
+    # Background tasks run in order: drop results cached while indexing was in progress
+    background_tasks.add_task(_invalidate_search_cache, user_id, request.project_name)
+    return {"status": "success", "message": f"File '{request.file_path}' is being processed."}
 
 @router.post("/index/file", status_code=status.HTTP_202_ACCEPTED)
 async def index_binary_file(
+    background_tasks: BackgroundTasks,
     project_name: str = Form(...),
     file: UploadFile = File(...),
-    current_user: models.User = Depends(get_current_user)
+    current_user: AuthenticatedUser = Depends(get_current_user),
+    indexing_service: IndexingService = Depends(get_indexer)
 ):
     """
     Upload and index binary files (images, PDFs, DOCX, etc.)
     Uses multipart/form-data for file upload.
+    Indexing runs in the background once the response has been sent.
     """
+    if file.size is not None and file.size > MAX_UPLOAD_SIZE:
+        raise HTTPException(
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail=f"File exceeds the maximum upload size of {MAX_UPLOAD_SIZE} bytes."
+        )
+
+    if not indexing_service.is_supported_file(file.filename):
+        raise HTTPException(status_code=400, detail=f"Unsupported file type: {file.filename}")
+
     try:
-        # Read file bytes
-        file_bytes = await file.read()
-        
-        # Use the smart indexing method that auto-detects file type
-        indexing_service.index_file(
-            user_id=str(current_user.id),
+        user_id = str(current_user.id)
+        staged_path = await _stage_upload(file)
+        _invalidate_search_cache(user_id, project_name)
+        background_tasks.add_task(
+            _index_staged_file,
+            indexing_service=indexing_service,
+            user_id=user_id,
             project_name=project_name,
             file_path=file.filename,
-            file_bytes=file_bytes
+            staged_path=staged_path
         )
+        background_tasks.add_task(_invalidate_search_cache, user_id, project_name)
         
         return {
             "status": "success", 
             "message": f"File '{file.filename}' is being processed.",
-            "file_size": len(file_bytes),
+            "file_size": file.size,
             "content_type": file.content_type
         }
-    except ValueError as e:
-        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @router.post("/search")
-def search_code(
+async def search_code(
     request: schemas.SearchRequest,
-    current_user: models.User = Depends(get_current_user)
+    response: Response,
+    current_user: AuthenticatedUser = Depends(get_current_user)
 ):
     """
     Performs a search query for the authenticated user.
+    Results are cached for a short time; the X-Cache header reports HIT (same or
+    semantically equivalent query) or MISS.
     """
-    results = search_service(
-        user_id=str(current_user.id),
+    user_id = str(current_user.id)
+    cache_key = (user_id, request.project_name, request.query, request.top_k)
+    with _search_cache_lock:
+        results = _search_cache.get(cache_key)
+    if results is not None:
+        response.headers["X-Cache"] = "HIT"
+        return results
+
+    results, semantic_cache_hit = await search_service(
+        user_id=user_id,
         project_name=request.project_name,
         query_string=request.query,
         top_k=request.top_k
     )
     if results is None:
         raise HTTPException(status_code=500, detail="Search failed.")
+
+    with _search_cache_lock:
+        _search_cache[cache_key] = results
+    response.headers["X-Cache"] = "HIT" if semantic_cache_hit else "MISS"
     return results
 
 @router.post("/clean")
-def clean_user_index(
+async def clean_user_index(
     project_name: str = Body(None, embed=True),
-    current_user: models.User = Depends(get_current_user)
+    current_user: AuthenticatedUser = Depends(get_current_user)
 ):
     """
     Cleans all documents for a specific project for the authenticated user.
@@ -94,8 +192,10 @@ def clean_user_index(
     if not project_name:
          raise HTTPException(status_code=400, detail="Project name must be provided.")
 
-    result = clean_service(
-        user_id=str(current_user.id),
+    user_id = str(current_user.id)
+    result = await clean_service(
+        user_id=user_id,
         project_name=project_name
     )
+    _invalidate_search_cache(user_id, project_name)
     return result
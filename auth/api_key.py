@@ -1,26 +1,63 @@
+import threading
+import uuid
+from dataclasses import dataclass
+
+from cachetools import TTLCache
 from fastapi import Security, Depends, HTTPException, status
 from fastapi.security import APIKeyHeader
-from sqlalchemy.orm import Session
+from sqlalchemy.orm import Session, joinedload
 
 from ..db import models
 from ..api.dependencies import get_db
 
 api_key_header = APIKeyHeader(name="X-API-Key")
 
+# API key -> AuthenticatedUser, so repeated requests skip the database lookup
+_user_cache = TTLCache(maxsize=10_000, ttl=60)
+_user_cache_lock = threading.Lock()
+
+
+@dataclass(frozen=True)
+class AuthenticatedUser:
+    """Detached snapshot of the user owning an API key (safe to cache across sessions)."""
+    id: uuid.UUID
+    email: str
+
+
 def get_user_by_api_key(db: Session, api_key: str):
-    return db.query(models.User).join(models.ApiKey).filter(models.ApiKey.key == api_key).first()
+    db_api_key = (
+        db.query(models.ApiKey)
+        .options(joinedload(models.ApiKey.user))
+        .filter(models.ApiKey.key == api_key)
+        .first()
+    )
+    return db_api_key.user if db_api_key else None
 
-def get_current_user(api_key: str = Security(api_key_header), db: Session = Depends(get_db)):
+def invalidate_cached_user(api_key: str):
+    """Drop a cached API key lookup, e.g. when the key is revoked."""
+    with _user_cache_lock:
+        _user_cache.pop(api_key, None)
+
+def get_current_user(api_key: str = Security(api_key_header), db: Session = Depends(get_db)) -> AuthenticatedUser:
     if not api_key:
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             detail="An API key is required."
         )
-    
+
+    with _user_cache_lock:
+        cached_user = _user_cache.get(api_key)
+    if cached_user is not None:
+        return cached_user
+
     user = get_user_by_api_key(db, api_key)
     if user is None:
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             detail="Invalid API Key."
         )
-    return user
+
+    authenticated_user = AuthenticatedUser(id=user.id, email=user.email)
+    with _user_cache_lock:
+        _user_cache[api_key] = authenticated_user
+    return authenticated_user
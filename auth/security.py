@@ -1,12 +1,13 @@
 import secrets
-import random
 
 # API Key Generation
 def generate_api_key() -> str:
     """Generates a secure, URL-safe API key."""
+    # Draw fresh entropy per key: a pre-read buffer would be duplicated
+    # across forked worker processes and hand out identical keys.
     return secrets.token_urlsafe(32)
 
 # Verification Code Generation
 def generate_verification_code(length: int = 6) -> str:
-    """Generates a random numerical verification code of a given length."""
-    return "".join([str(random.randint(0, 9)) for _ in range(length)])
\ No newline at end of file
+    """Generates a cryptographically secure numerical verification code of a given length."""
+    return f"{secrets.randbelow(10 ** length):0{length}d}"
\ No newline at end of file
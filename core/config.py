@@ -9,21 +9,39 @@ DATABASE_URL = os.getenv("DATABASE_URL")
 if not DATABASE_URL:
     raise ValueError("DATABASE_URL environment variable not set or .env file not found.")
 
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "20"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_QUERY_CACHE_SIZE = int(os.getenv("DB_QUERY_CACHE_SIZE", "1200"))
+
 # --- Elasticsearch ---
 ES_HOST = os.getenv("ES_HOST", "http://localhost:9200")
 ES_INDEX = os.getenv("ES_INDEX", "codesearch_index")
 ES_API_KEY = os.getenv("ES_API_KEY")
+# HNSW quantization of code_embedding: "int8_hnsw", or "bbq_hnsw" for 1-bit codes rescored with floats
+ES_VECTOR_INDEX_TYPE = os.getenv("ES_VECTOR_INDEX_TYPE", "int8_hnsw")
+# Rank candidates in Python when the kNN search fails (e.g. on an index not migrated to int8_hnsw)
+SEARCH_MANUAL_RERANK_FALLBACK = os.getenv("SEARCH_MANUAL_RERANK_FALLBACK", "true").lower() == "true"
 
 if not ES_API_KEY:
     raise ValueError("ES_API_KEY environment variable not set or .env file not found.")
 
 # --- Model ---
 MODEL_NAME = os.getenv("MODEL_NAME", "all-MiniLM-L6-v2")
+# "onnx" runs the int8-quantized ONNX export with ONNX Runtime, "torch" the original PyTorch weights
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "onnx")
+ONNX_MODEL_FILE = os.getenv("ONNX_MODEL_FILE")  # Defaults to the export matching the CPU, see model_manager
+EMBEDDING_NUM_THREADS = int(os.getenv("EMBEDDING_NUM_THREADS", str(os.cpu_count() or 1)))
+
+# --- Uploads ---
+MAX_UPLOAD_SIZE = int(os.getenv("MAX_UPLOAD_SIZE", str(50 * 1024 * 1024)))  # bytes
+UPLOAD_STAGING_DIR = os.getenv("UPLOAD_STAGING_DIR")  # Defaults to the system temp directory
 
 # --- FeatherlessAI ---
 FEATHERLESS_API_KEY = os.getenv("FEATHERLESS_API_KEY")
 FEATHERLESS_BASE_URL = os.getenv("FEATHERLESS_BASE_URL", "https://api.featherless.ai/v1")
 FEATHERLESS_VISION_MODEL = os.getenv("FEATHERLESS_VISION_MODEL", "google/gemma-3-27b-it")
+# Processes resizing images before vision calls (per app worker, on top of EMBEDDING_NUM_THREADS)
+IMAGE_RESIZE_WORKERS = int(os.getenv("IMAGE_RESIZE_WORKERS", "2"))
 
 # --- Auth ---
 # This is for JWT, which we might use later for a web UI
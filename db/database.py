@@ -1,8 +1,14 @@
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
-from ..core.config import DATABASE_URL
+from ..core.config import DATABASE_URL, DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_QUERY_CACHE_SIZE
 
-engine = create_engine(DATABASE_URL)
+engine = create_engine(
+    DATABASE_URL,
+    query_cache_size=DB_QUERY_CACHE_SIZE,  # Compiled SQL cache shared by all sessions
+    pool_size=DB_POOL_SIZE,
+    max_overflow=DB_MAX_OVERFLOW,
+    pool_pre_ping=True,  # Transparently replace connections dropped by the server
+)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
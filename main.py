@@ -1,8 +1,23 @@
 from fastapi import FastAPI
 from .api import auth, mgrep
+from .services.indexing_service import IndexingService
+from .services.es_manager import close_es_client
+from .services.vision_service import shutdown_resize_pool
 
 app = FastAPI(title="CodeSearch API")
 
+@app.on_event("startup")
+async def load_services():
+    # One IndexingService (and embedding model) per worker process, warmed up before serving traffic
+    app.state.indexer = IndexingService()
+    await app.state.indexer.setup()
+    app.state.indexer.warmup()
+
+@app.on_event("shutdown")
+async def close_services():
+    await close_es_client()
+    shutdown_resize_pool()
+
 app.include_router(auth.router, prefix="/auth", tags=["authentication"])
 app.include_router(mgrep.router, prefix="/api", tags=["mgrep"])
 
@@ -2,12 +2,21 @@
 Document processing service for extracting text from various file formats.
 """
 import os
-from typing import Optional
+import re
+import threading
+from typing import BinaryIO, Optional
 
 import markdown
+import pypdfium2 as pdfium
 from docx import Document
 from PyPDF2 import PdfReader
 
+# Matches HTML tags left by the markdown -> HTML conversion
+_TAG_RE = re.compile(r'<[^>]+>')
+
+# PDFium is not thread-safe: calls must be serialized across the whole process
+_PDFIUM_LOCK = threading.Lock()
+
 
 class DocumentService:
     """Service for extracting text content from various document formats."""
@@ -25,19 +34,49 @@ class DocumentService:
     def is_supported(file_path: str) -> bool:
         """Check if file extension is supported."""
         _, ext = os.path.splitext(file_path.lower())
+        return DocumentService.is_supported_ext(ext)
+
+    @staticmethod
+    def is_supported_ext(ext: str) -> bool:
+        """Check if an already lower-cased extension (e.g. '.pdf') is supported."""
         return ext in DocumentService.SUPPORTED_EXTENSIONS
     
     @staticmethod
-    def extract_text_from_pdf(file_bytes: bytes) -> str:
-        """Extract text from PDF bytes."""
-        from io import BytesIO
-        
+    def _extract_pdf_pages_with_pdfium(file_obj: BinaryIO) -> list:
+        """Extract the text of each page with PDFium (native, much faster than PyPDF2)."""
+        with _PDFIUM_LOCK:
+            pdf = pdfium.PdfDocument(file_obj)
+            try:
+                pages = []
+                for page_index in range(len(pdf)):
+                    page = pdf[page_index]
+                    textpage = page.get_textpage()
+                    pages.append(textpage.get_text_range().replace('\r\n', '\n'))
+                    textpage.close()
+                    page.close()
+                return pages
+            finally:
+                pdf.close()
+
+    @staticmethod
+    def _extract_pdf_pages_with_pypdf2(file_obj: BinaryIO) -> list:
+        """Extract the text of each page with PyPDF2 (pure Python fallback)."""
+        pdf = PdfReader(file_obj)
+        return [page.extract_text() for page in pdf.pages]
+
+    @staticmethod
+    def extract_text_from_pdf(file_obj: BinaryIO) -> str:
+        """Extract text from a PDF file object."""
         try:
-            pdf = PdfReader(BytesIO(file_bytes))
+            try:
+                pages = DocumentService._extract_pdf_pages_with_pdfium(file_obj)
+            except Exception as e:
+                print(f"PDFium failed to parse PDF, falling back to PyPDF2: {e}")
+                file_obj.seek(0)
+                pages = DocumentService._extract_pdf_pages_with_pypdf2(file_obj)
+
             text_parts = []
-            
-            for page_num, page in enumerate(pdf.pages, 1):
-                text = page.extract_text()
+            for page_num, text in enumerate(pages, 1):
                 if text.strip():
                     text_parts.append(f"--- Page {page_num} ---\n{text}")
             
@@ -47,12 +86,10 @@ class DocumentService:
             raise
     
     @staticmethod
-    def extract_text_from_docx(file_bytes: bytes) -> str:
-        """Extract text from DOCX bytes."""
-        from io import BytesIO
-        
+    def extract_text_from_docx(file_obj: BinaryIO) -> str:
+        """Extract text from a DOCX file object."""
         try:
-            doc = Document(BytesIO(file_bytes))
+            doc = Document(file_obj)
             paragraphs = [para.text for para in doc.paragraphs if para.text.strip()]
             return "\n\n".join(paragraphs)
         except Exception as e:
@@ -70,8 +107,7 @@ class DocumentService:
             # Convert markdown to HTML then strip tags for plain text
             html = markdown.markdown(md_text)
             # Simple HTML tag removal (or use BeautifulSoup for more robust parsing)
-            import re
-            text = re.sub(r'<[^>]+>', '', html)
+            text = _TAG_RE.sub('', html)
             return text
         except Exception as e:
             print(f"Failed to process Markdown: {e}")
@@ -84,31 +120,34 @@ class DocumentService:
         return file_bytes.decode('utf-8', errors='ignore')
     
     @classmethod
-    def extract_text(cls, file_path: str, file_bytes: bytes) -> str:
+    def extract_text(cls, file_path: str, file_obj: BinaryIO, ext: Optional[str] = None) -> str:
         """
         Extract text from a document based on its file extension.
         
         Args:
             file_path: Path/name of the file (used to determine type)
-            file_bytes: Raw file bytes
+            file_obj: Binary file object positioned at the start of the file
+            ext: Lower-cased extension of file_path, if the caller already computed it
         
         Returns:
             Extracted text content
         """
-        _, ext = os.path.splitext(file_path.lower())
+        if ext is None:
+            _, ext = os.path.splitext(file_path.lower())
         
-        if not cls.is_supported(file_path):
+        file_type = cls.SUPPORTED_EXTENSIONS.get(ext)
+        if file_type is None:
             raise ValueError(f"Unsupported file type: {ext}")
         
-        file_type = cls.SUPPORTED_EXTENSIONS[ext]
-        
+        # PDF and DOCX parsers read straight from the file object;
+        # markdown and plain text need the raw bytes
         if file_type == 'pdf':
-            return cls.extract_text_from_pdf(file_bytes)
+            return cls.extract_text_from_pdf(file_obj)
         elif file_type == 'docx':
-            return cls.extract_text_from_docx(file_bytes)
+            return cls.extract_text_from_docx(file_obj)
         elif file_type == 'markdown':
-            return cls.extract_text_from_markdown(file_bytes)
+            return cls.extract_text_from_markdown(file_obj.read())
         elif file_type == 'text':
-            return cls.extract_text_from_text(file_bytes)
+            return cls.extract_text_from_text(file_obj.read())
         else:
             raise ValueError(f"Handler not implemented for type: {file_type}")
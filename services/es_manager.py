@@ -1,10 +1,62 @@
-from elasticsearch import Elasticsearch
-from ..core.config import ES_HOST, ES_INDEX, ES_API_KEY
+from functools import lru_cache
 
+from elasticsearch import AsyncElasticsearch
+from ..core.config import ES_HOST, ES_INDEX, ES_API_KEY, ES_VECTOR_INDEX_TYPE
+
+INDEX_MAPPINGS = {
+    "properties": {
+        "user_id": {"type": "keyword"},
+        "project_name": {"type": "keyword"},
+        "file_path": {"type": "keyword"},
+        "content_hash": {"type": "keyword"},  # xxh3 of the embedding model identity + source file
+        "content_type": {"type": "keyword"},  # code, image, document
+        "language": {"type": "keyword"},
+        "class_name": {"type": "keyword"},
+        "function_name": {"type": "keyword"},
+        "code_content": {"type": "text"},
+        "code_embedding": {
+            "type": "dense_vector",
+            "dims": 384,
+            "index": True,
+            "similarity": "dot_product",  # embeddings are stored L2-normalized
+            # Elasticsearch quantizes the float vectors (int8 or 1-bit) in the HNSW graph
+            "index_options": {"type": ES_VECTOR_INDEX_TYPE, "m": 16, "ef_construction": 100}
+        },
+        "line_start": {"type": "integer"},
+        "line_end": {"type": "integer"},
+    }
+}
+
+# L2-normalizes the embeddings while reindexing, as `dot_product` requires
+_NORMALIZE_EMBEDDING_SCRIPT = """
+def v = ctx._source.code_embedding;
+if (v != null) {
+    double norm = 0;
+    for (def x : v) { norm += x * x; }
+    norm = Math.sqrt(norm);
+    if (norm > 0) {
+        List normalized = new ArrayList();
+        for (def x : v) { normalized.add(x / norm); }
+        ctx._source.code_embedding = normalized;
+    }
+}
+"""
+
+@lru_cache(maxsize=1)
 def get_es_client():
-    return Elasticsearch(ES_HOST, api_key=ES_API_KEY)
+    """
+    Returns the process-wide async Elasticsearch client (it holds the connection pool).
+    Request bodies are gzip-compressed, mostly to shrink embedding-heavy bulk requests.
+    """
+    return AsyncElasticsearch(ES_HOST, api_key=ES_API_KEY, http_compress=True)
 
-def clean_index(user_id: str = None, project_name: str = None, delete_all: bool = False):
+async def close_es_client():
+    """Closes the shared client's connections, if it was ever created."""
+    if get_es_client.cache_info().currsize:
+        await get_es_client().close()
+        get_es_client.cache_clear()
+
+async def clean_index(user_id: str = None, project_name: str = None, delete_all: bool = False):
     """
     Cleans the Elasticsearch index.
     - If delete_all is True, the entire index is deleted (admin operation).
@@ -14,8 +66,8 @@ def clean_index(user_id: str = None, project_name: str = None, delete_all: bool
     es = get_es_client()
 
     if delete_all:
-        if es.indices.exists(index=ES_INDEX):
-            es.indices.delete(index=ES_INDEX)
+        if await es.indices.exists(index=ES_INDEX):
+            await es.indices.delete(index=ES_INDEX)
             return {"status": "success", "message": f"Index '{ES_INDEX}' deleted."}
         return {"status": "success", "message": "Index did not exist."}
 
@@ -30,7 +82,7 @@ def clean_index(user_id: str = None, project_name: str = None, delete_all: bool
         msg_scope = f"user '{user_id}'"
 
     
-    response = es.delete_by_query(
+    response = await es.delete_by_query(
         index=ES_INDEX,
         body={"query": {"bool": {"filter": filters}}},
         refresh=True
@@ -42,14 +94,48 @@ def clean_index(user_id: str = None, project_name: str = None, delete_all: bool
     
     return {"status": "success", "message": f"No documents found for {msg_scope}."}
 
-def get_all_documents():
+async def get_all_documents():
     """
     Retrieves all documents from the index for debugging.
     """
     es = get_es_client()
-    if not es.indices.exists(index=ES_INDEX):
+    if not await es.indices.exists(index=ES_INDEX):
         return {"error": "Index does not exist."}
     
-    return es.search(index=ES_INDEX, body={"query": {"match_all": {}}}, size=100)
+    return await es.search(index=ES_INDEX, body={"query": {"match_all": {}}}, size=100)
+
+async def migrate_index(new_index: str):
+    """
+    One-off migration of an existing index to INDEX_MAPPINGS.
+    Reindexes every document into `new_index`, then makes ES_INDEX an alias of it.
+    The previous index is deleted, unless ES_INDEX was already an alias
+    (the index it pointed to is then left for the admin to remove).
+    Meant to be run on its own (see README): closes the shared client when done.
+    """
+    es = get_es_client()
+    try:
+        print(f"Creating index '{new_index}'...")
+        await es.indices.create(index=new_index, body={"mappings": INDEX_MAPPINGS})
 
+        print(f"Reindexing '{ES_INDEX}' into '{new_index}'...")
+        response = await es.options(request_timeout=3600).reindex(
+            body={
+                "source": {"index": ES_INDEX},
+                "dest": {"index": new_index},
+                "script": {"lang": "painless", "source": _NORMALIZE_EMBEDDING_SCRIPT}
+            },
+            refresh=True
+        )
+        print(f"Reindexed {response.get('total', 0)} documents.")
 
+        # Swap atomically: no write can land between removing the old name and adding the alias
+        if await es.indices.exists_alias(name=ES_INDEX):
+            old_indices = list((await es.indices.get_alias(name=ES_INDEX)).keys())
+            actions = [{"remove": {"index": index, "alias": ES_INDEX}} for index in old_indices]
+        else:
+            actions = [{"remove_index": {"index": ES_INDEX}}]
+        actions.append({"add": {"index": new_index, "alias": ES_INDEX}})
+        await es.indices.update_aliases(body={"actions": actions})
+        print(f"'{ES_INDEX}' now points to '{new_index}'.")
+    finally:
+        await close_es_client()
@@ -1,80 +1,103 @@
+import asyncio
 import os
+import weakref
+from typing import BinaryIO, Optional
 
-from elasticsearch import Elasticsearch
-from sentence_transformers import SentenceTransformer
+import numpy as np
+import xxhash
+from elasticsearch.helpers import async_bulk
 from tree_sitter import Parser
 from tree_sitter_languages import get_language
 
-from ..core.config import ES_HOST, ES_INDEX, ES_API_KEY, MODEL_NAME
+from ..core.config import ES_INDEX
+from .es_manager import get_es_client, INDEX_MAPPINGS
+from .model_manager import get_model, get_model_identity
 from .vision_service import VisionService
 from .document_service import DocumentService
 
 CHUNK_SIZE = 20
+EMBEDDING_BATCH_SIZE = 64
+BULK_CHUNK_SIZE = 500
+HASH_READ_CHUNK_SIZE = 1024 * 1024
 SUPPORTED_CODE_LANGUAGES = {
     ".py": "python",
 }
 
-SUPPORTED_IMAGE_FORMATS = {
-    '.png', '.jpg', '.jpeg', '.gif', '.bmp', '.webp'
+# Tree-sitter queries selecting the nodes indexed as separate chunks, per language
+AST_QUERIES = {
+    "python": """
+    (class_definition) @class
+    (function_definition) @function
+    """,
 }
 
+SUPPORTED_IMAGE_FORMATS = frozenset({
+    '.png', '.jpg', '.jpeg', '.gif', '.bmp', '.webp'
+})
+
 
 class IndexingService:
     def __init__(self):
         print("Initializing IndexingService...")
-        self.es = Elasticsearch(ES_HOST, api_key=ES_API_KEY)
-        self.model = SentenceTransformer(MODEL_NAME)
+        self.es = get_es_client()
+        self.model = get_model()
+        # Seeds every content hash, so files are re-embedded when the model changes
+        self.model_identity = get_model_identity().encode('utf-8')
         self.vision_service = None  # Lazy init
         self.document_service = DocumentService()
-        self.parser = Parser()
-        self._create_index_if_not_exists()
+        # Per-file locks serializing concurrent re-indexing of the same file
+        self._file_locks = weakref.WeakValueDictionary()
+        # Load grammars and compile AST queries once instead of on every file
+        self.languages = {name: get_language(name) for name in set(SUPPORTED_CODE_LANGUAGES.values())}
+        self.ast_queries = {
+            name: self.languages[name].query(query_string)
+            for name, query_string in AST_QUERIES.items()
+            if name in self.languages
+        }
         print("IndexingService initialized.")
 
-    def _create_index_if_not_exists(self):
-        if not self.es.indices.exists(index=ES_INDEX):
+    async def setup(self):
+        """Prepare the Elasticsearch index. Must be awaited once before indexing."""
+        await self._create_index_if_not_exists()
+
+    def warmup(self):
+        """Run a dummy encode so the first real request doesn't pay the model's lazy initialization."""
+        self.model.encode("warmup")
+
+    def _encode(self, texts):
+        """
+        Embed texts in batches as L2-normalized vectors, as the `dot_product` mapping requires
+        (CPU/GPU bound, call through asyncio.to_thread).
+        Returns float32 values as plain lists, converted once for the whole batch.
+        """
+        embeddings = self.model.encode(
+            texts, batch_size=EMBEDDING_BATCH_SIZE, normalize_embeddings=True,
+            convert_to_numpy=True, show_progress_bar=False
+        )
+        return embeddings.astype(np.float32, copy=False).tolist()
+
+    async def _create_index_if_not_exists(self):
+        if not await self.es.indices.exists(index=ES_INDEX):
             print(f"Creating index '{ES_INDEX}'...")
-            self.es.indices.create(
+            await self.es.indices.create(
                 index=ES_INDEX,
-                body={
-                    "mappings": {
-                        "properties": {
-                            "user_id": {"type": "keyword"},
-                            "project_name": {"type": "keyword"},
-                            "file_path": {"type": "keyword"},
-                            "content_type": {"type": "keyword"},  # code, image, document
-                            "language": {"type": "keyword"},
-                            "class_name": {"type": "keyword"},
-                            "function_name": {"type": "keyword"},
-                            "code_content": {"type": "text"},
-                            "code_embedding": {
-                                "type": "dense_vector",
-                                "dims": 384
-                            },
-                            "line_start": {"type": "integer"},
-                            "line_end": {"type": "integer"},
-                        }
-                    }
-                }
+                body={"mappings": INDEX_MAPPINGS}
             )
             print("Index created.")
     
-    def recreate_index(self):
+    async def recreate_index(self):
         """Delete and recreate the index with proper mappings"""
-        if self.es.indices.exists(index=ES_INDEX):
+        if await self.es.indices.exists(index=ES_INDEX):
             print(f"Deleting existing index '{ES_INDEX}'...")
-            self.es.indices.delete(index=ES_INDEX)
+            await self.es.indices.delete(index=ES_INDEX)
             print("Index deleted.")
-        self._create_index_if_not_exists()
+        await self._create_index_if_not_exists()
 
-    def _get_ast_nodes(self, tree, lang_object):
-        if lang_object.name != "python":
+    def _get_ast_nodes(self, tree, lang_name):
+        query = self.ast_queries.get(lang_name)
+        if query is None:
             return []
 
-        query_string = """
-        (class_definition) @class
-        (function_definition) @function
-        """
-        query = lang_object.query(query_string)
         captures = query.captures(tree.root_node)
 
         nodes = []
@@ -87,70 +110,137 @@ class IndexingService:
             nodes.append({
                 "name": name,
                 "type": node_type,
-                "content": node.text.decode('utf8'),
+                "start_byte": node.start_byte,
+                "end_byte": node.end_byte,
                 "start_line": node.start_point[0],
                 "end_line": node.end_point[0]
             })
         return nodes
 
-    def index_file_content(self, user_id: str, project_name: str, file_path: str, file_content: str):
+    @staticmethod
+    def _get_line_offsets(source: bytes):
+        """Byte offset at which each line of source starts."""
+        offsets = [0]
+        pos = source.find(b"\n")
+        while pos != -1:
+            offsets.append(pos + 1)
+            pos = source.find(b"\n", pos + 1)
+        return offsets
+
+    @staticmethod
+    def _iter_node_chunks(source: bytes, line_offsets, node):
+        """
+        Yield (content, line_start, line_end) for each CHUNK_SIZE-line chunk of an AST node,
+        slicing the source buffer directly instead of splitting and re-joining lines.
+        """
+        for line_start in range(node['start_line'], node['end_line'] + 1, CHUNK_SIZE):
+            line_end = min(line_start + CHUNK_SIZE - 1, node['end_line'])
+            start = node['start_byte'] if line_start == node['start_line'] else line_offsets[line_start]
+            end = node['end_byte']
+            if line_end + 1 < len(line_offsets):
+                # Stop before the newline ending the chunk's last line
+                end = min(end, line_offsets[line_end + 1] - 1)
+            # Same text as splitting the node's lines and re-joining them with \n (CRLF sources included)
+            content = source[start:end].decode('utf8').replace('\r\n', '\n').rstrip('\r')
+            yield content, line_start, line_end
+
+    def _chunk_code(self, source: bytes, lang_name: str):
+        """Parse source code and split its classes/functions into chunks with their metadata."""
+        # Parsers are cheap but not thread-safe, so each call gets its own
+        parser = Parser()
+        parser.set_language(self.languages[lang_name])
+
+        tree = parser.parse(source)
+        nodes = self._get_ast_nodes(tree, lang_name)
+        line_offsets = self._get_line_offsets(source)
+
+        chunks = []
+        metas = []
+        for node in nodes:
+            for chunk_content, line_start, line_end in self._iter_node_chunks(source, line_offsets, node):
+                if not chunk_content.strip():
+                    continue
+
+                chunks.append(chunk_content)
+                metas.append({
+                    "class_name": node['name'] if node['type'] == 'class' else None,
+                    "function_name": node['name'] if node['type'] == 'function' else None,
+                    "line_start": line_start,
+                    "line_end": line_end,
+                })
+        return nodes, chunks, metas
+
+    async def index_file_content(self, user_id: str, project_name: str, file_path: str, file_content: str):
         """
         Parses, chunks, embeds, and indexes a single file's content.
         Removes existing entries for this file before indexing to avoid duplicates.
         """
         print(f"Indexing file for user '{user_id}', project '{project_name}': {file_path}")
+
+        file_content_bytes = file_content.encode('utf-8')
+        async with self._file_lock(user_id, project_name, file_path):
+            content_hash = self._content_hash(file_content_bytes)
+            if await self._is_already_indexed(user_id, project_name, file_path, content_hash):
+                print(f"File unchanged since last indexing, skipping: {file_path}")
+                return
         
-        # Remove existing entries for this specific file/user/project combination
-        self.remove_file_from_index(user_id, project_name, file_path)
+            # Remove existing entries for this specific file/user/project combination
+            await self.remove_file_from_index(user_id, project_name, file_path, keep_hash=content_hash)
         
-        _, ext = os.path.splitext(file_path)
-        lang_name = SUPPORTED_CODE_LANGUAGES.get(ext)
-        if not lang_name:
-            return
+            _, ext = os.path.splitext(file_path)
+            lang_name = SUPPORTED_CODE_LANGUAGES.get(ext)
+            if not lang_name:
+                return
 
-        lang_object = get_language(lang_name)
-        self.parser.set_language(lang_object)
+            try:
+                # Parsing and embedding are CPU bound: keep them off the event loop
+                nodes, chunks, metas = await asyncio.to_thread(self._chunk_code, file_content_bytes, lang_name)
 
-        try:
-            file_content_bytes = file_content.encode('utf-8')
-            tree = self.parser.parse(file_content_bytes)
-            nodes = self._get_ast_nodes(tree, lang_object)
+                docs = []
+                if chunks:
+                    # Encode every chunk of the file in a single batched forward pass
+                    embeddings = await asyncio.to_thread(self._encode, chunks)
 
-            for node in nodes:
-                lines = node['content'].splitlines()
-                for i in range(0, len(lines), CHUNK_SIZE):
-                    chunk_lines = lines[i:i + CHUNK_SIZE]
-                    chunk_content = "\n".join(chunk_lines)
-                    
-                    if not chunk_content.strip():
-                        continue
+                    for chunk_content, meta, embedding in zip(chunks, metas, embeddings):
+                        docs.append({
+                            "user_id": user_id,
+                            "project_name": project_name,
+                            "file_path": file_path,
+                            "content_hash": content_hash,
+                            "content_type": "code",
+                            "language": lang_name,
+                            "class_name": meta['class_name'],
+                            "function_name": meta['function_name'],
+                            "code_content": chunk_content,
+                            "code_embedding": embedding,
+                            "line_start": meta['line_start'],
+                            "line_end": meta['line_end'],
+                        })
 
-                    embedding = self.model.encode(chunk_content)
-                    
-                    doc = {
-                        "user_id": user_id,
-                        "project_name": project_name,
-                        "file_path": file_path,
-                        "content_type": "code",
-                        "language": lang_name,
-                        "class_name": node['name'] if node['type'] == 'class' else None,
-                        "function_name": node['name'] if node['type'] == 'function' else None,
-                        "code_content": chunk_content,
-                        "code_embedding": embedding.tolist(),
-                        "line_start": node['start_line'] + i,
-                        "line_end": node['start_line'] + i + len(chunk_lines) - 1,
-                    }
-                    
-                    self.es.index(index=ES_INDEX, document=doc, refresh=True)
-            print(f"Successfully indexed {len(nodes)} nodes from {file_path}")
+                await self._bulk_index(docs)
+                print(f"Successfully indexed {len(nodes)} nodes from {file_path}")
 
-        except Exception as e:
-            print(f"Failed to index {file_path}: {e}")
+            except Exception as e:
+                print(f"Failed to index {file_path}: {e}")
+                await self._remove_partial_index(user_id, project_name, file_path, content_hash)
 
-    def remove_file_from_index(self, user_id: str, project_name: str, file_path: str):
-        """Remove all entries for a specific file/user/project combination"""
-        print(f"Removing existing entries for user '{user_id}', project '{project_name}', file: {file_path}")
-        self.es.delete_by_query(
+    def _content_hash(self, content: bytes) -> str:
+        """xxh3 of the embedding model's identity followed by the file content."""
+        hasher = xxhash.xxh3_64(self.model_identity)
+        hasher.update(content)
+        return hasher.hexdigest()
+
+    def _hash_file(self, file_obj: BinaryIO) -> str:
+        """Stream a file object through _content_hash's xxh3, then rewind it for the caller."""
+        hasher = xxhash.xxh3_64(self.model_identity)
+        while chunk := file_obj.read(HASH_READ_CHUNK_SIZE):
+            hasher.update(chunk)
+        file_obj.seek(0)
+        return hasher.hexdigest()
+
+    async def _is_already_indexed(self, user_id: str, project_name: str, file_path: str, content_hash: str) -> bool:
+        """Check whether this exact file content is already indexed, so re-indexing can be skipped."""
+        response = await self.es.count(
             index=ES_INDEX,
             body={
                 "query": {
@@ -158,113 +248,217 @@ class IndexingService:
                         "filter": [
                             {"term": {"user_id": user_id}},
                             {"term": {"project_name": project_name}},
-                            {"term": {"file_path": file_path}}
+                            {"term": {"file_path": file_path}},
+                            {"term": {"content_hash": content_hash}}
                         ]
                     }
                 }
-            },
-            refresh=True
+            }
         )
+        return response['count'] > 0
+
+    def _file_lock(self, user_id: str, project_name: str, file_path: str) -> asyncio.Lock:
+        """Returns the lock guarding (re-)indexing of one file."""
+        key = (user_id, project_name, file_path)
+        lock = self._file_locks.get(key)
+        if lock is None:
+            lock = asyncio.Lock()
+            self._file_locks[key] = lock
+        return lock
+
+    async def remove_file_from_index(self, user_id: str, project_name: str, file_path: str, keep_hash: str = None):
+        """
+        Remove all entries for a specific file/user/project combination.
+        Entries whose content_hash is keep_hash are spared, so the deletion cannot hit
+        the new version of the file indexed right after it. Waits for the deletion
+        (callers hold the file's lock) but doesn't refresh: the refresh after the
+        bulk indexing makes both visible at once.
+        """
+        print(f"Removing existing entries for user '{user_id}', project '{project_name}', file: {file_path}")
+        query = {
+            "bool": {
+                "filter": [
+                    {"term": {"user_id": user_id}},
+                    {"term": {"project_name": project_name}},
+                    {"term": {"file_path": file_path}}
+                ]
+            }
+        }
+        if keep_hash:
+            query["bool"]["must_not"] = [{"term": {"content_hash": keep_hash}}]
+        await self.es.delete_by_query(
+            index=ES_INDEX,
+            body={"query": query},
+            wait_for_completion=True,
+            refresh=False
+        )
+
+    async def _remove_partial_index(self, user_id: str, project_name: str, file_path: str, content_hash: str):
+        """
+        Delete whatever a failed indexing run wrote for this content: async_bulk isn't
+        transactional, and leftover chunks would make _is_already_indexed skip the file.
+        """
+        try:
+            await self.es.delete_by_query(
+                index=ES_INDEX,
+                body={
+                    "query": {
+                        "bool": {
+                            "filter": [
+                                {"term": {"user_id": user_id}},
+                                {"term": {"project_name": project_name}},
+                                {"term": {"file_path": file_path}},
+                                {"term": {"content_hash": content_hash}}
+                            ]
+                        }
+                    }
+                },
+                refresh=True
+            )
+        except Exception as e:
+            print(f"Failed to remove partially indexed entries for {file_path}: {e}")
+
+    async def _bulk_index(self, docs):
+        """
+        Index documents in a single bulk request, then refresh once so they
+        become searchable (instead of one request and one refresh per document).
+        The refresh also publishes the preceding remove_file_from_index, even with no docs.
+        """
+        if docs:
+            actions = ({"_index": ES_INDEX, "_source": doc} for doc in docs)
+            await async_bulk(self.es, actions, chunk_size=BULK_CHUNK_SIZE, refresh=False)
+        await self.es.indices.refresh(index=ES_INDEX)
     
-    def index_image(self, user_id: str, project_name: str, file_path: str, image_bytes: bytes):
+    async def index_image(self, user_id: str, project_name: str, file_path: str, image_bytes: bytes):
         """
         Index an image by generating a description using vision AI,
         then creating an embedding of the description.
         """
         print(f"Indexing image for user '{user_id}', project '{project_name}': {file_path}")
+
+        async with self._file_lock(user_id, project_name, file_path):
+            content_hash = self._content_hash(image_bytes)
+            if await self._is_already_indexed(user_id, project_name, file_path, content_hash):
+                print(f"Image unchanged since last indexing, skipping: {file_path}")
+                return
         
-        # Remove existing entries
-        self.remove_file_from_index(user_id, project_name, file_path)
+            # Remove existing entries
+            await self.remove_file_from_index(user_id, project_name, file_path, keep_hash=content_hash)
         
-        # Lazy init vision service
-        if self.vision_service is None:
-            self.vision_service = VisionService()
+            # Lazy init vision service
+            if self.vision_service is None:
+                self.vision_service = VisionService()
         
-        try:
-            # Generate description using vision AI
-            description = self.vision_service.describe_image(image_bytes)
+            try:
+                # Generate description using vision AI
+                description = await self.vision_service.describe_image_async(image_bytes)
             
-            # Generate embedding from description
-            embedding = self.model.encode(description)
+                # Generate embedding from description
+                embedding = (await asyncio.to_thread(self._encode, [description]))[0]
             
-            # Index the image with its description
-            doc = {
-                "user_id": user_id,
-                "project_name": project_name,
-                "file_path": file_path,
-                "content_type": "image",
-                "language": None,
-                "class_name": None,
-                "function_name": None,
-                "code_content": description,  # Store description as searchable content
-                "code_embedding": embedding.tolist(),
-                "line_start": None,
-                "line_end": None,
-            }
+                # Index the image with its description
+                doc = {
+                    "user_id": user_id,
+                    "project_name": project_name,
+                    "file_path": file_path,
+                    "content_hash": content_hash,
+                    "content_type": "image",
+                    "language": None,
+                    "class_name": None,
+                    "function_name": None,
+                    "code_content": description,  # Store description as searchable content
+                    "code_embedding": embedding,
+                    "line_start": None,
+                    "line_end": None,
+                }
             
-            self.es.index(index=ES_INDEX, document=doc, refresh=True)
-            print(f"Successfully indexed image: {file_path}")
+                await self._bulk_index([doc])
+                print(f"Successfully indexed image: {file_path}")
             
-        except Exception as e:
-            print(f"Failed to index image {file_path}: {e}")
-            raise
+            except Exception as e:
+                print(f"Failed to index image {file_path}: {e}")
+                await self._remove_partial_index(user_id, project_name, file_path, content_hash)
+                raise
     
-    def index_document(self, user_id: str, project_name: str, file_path: str, file_bytes: bytes):
+    async def index_document(self, user_id: str, project_name: str, file_path: str, file_obj: BinaryIO, ext: Optional[str] = None):
         """
         Index a document (PDF, DOCX, etc.) by extracting text,
         chunking it, and creating embeddings.
         """
         print(f"Indexing document for user '{user_id}', project '{project_name}': {file_path}")
+
+        async with self._file_lock(user_id, project_name, file_path):
+            content_hash = await asyncio.to_thread(self._hash_file, file_obj)
+            if await self._is_already_indexed(user_id, project_name, file_path, content_hash):
+                print(f"Document unchanged since last indexing, skipping: {file_path}")
+                return
         
-        # Remove existing entries
-        self.remove_file_from_index(user_id, project_name, file_path)
+            # Remove existing entries
+            await self.remove_file_from_index(user_id, project_name, file_path, keep_hash=content_hash)
         
-        try:
-            # Extract text from document
-            text_content = self.document_service.extract_text(file_path, file_bytes)
+            try:
+                # Extract text from document
+                text_content = await asyncio.to_thread(self.document_service.extract_text, file_path, file_obj, ext)
             
-            if not text_content.strip():
-                print(f"No text content extracted from {file_path}")
-                return
+                if not text_content.strip():
+                    print(f"No text content extracted from {file_path}")
+                    return
             
-            # Split into chunks (similar to code chunking)
-            lines = text_content.split('\n')
-            chunk_count = 0
+                # Split into chunks (similar to code chunking)
+                lines = text_content.split('\n')
+                chunks = []
+                line_ranges = []
             
-            for i in range(0, len(lines), CHUNK_SIZE):
-                chunk_lines = lines[i:i + CHUNK_SIZE]
-                chunk_content = "\n".join(chunk_lines)
-                
-                if not chunk_content.strip():
-                    continue
-                
-                # Generate embedding
-                embedding = self.model.encode(chunk_content)
+                for i in range(0, len(lines), CHUNK_SIZE):
+                    chunk_lines = lines[i:i + CHUNK_SIZE]
+                    chunk_content = "\n".join(chunk_lines)
                 
-                doc = {
-                    "user_id": user_id,
-                    "project_name": project_name,
-                    "file_path": file_path,
-                    "content_type": "document",
-                    "language": None,
-                    "class_name": None,
-                    "function_name": None,
-                    "code_content": chunk_content,
-                    "code_embedding": embedding.tolist(),
-                    "line_start": i,
-                    "line_end": i + len(chunk_lines) - 1,
-                }
+                    if not chunk_content.strip():
+                        continue
                 
-                self.es.index(index=ES_INDEX, document=doc, refresh=True)
-                chunk_count += 1
+                    chunks.append(chunk_content)
+                    line_ranges.append((i, i + len(chunk_lines) - 1))
             
-            print(f"Successfully indexed document {file_path} ({chunk_count} chunks)")
+                # Generate all embeddings in one batch
+                embeddings = await asyncio.to_thread(self._encode, chunks) if chunks else []
             
-        except Exception as e:
-            print(f"Failed to index document {file_path}: {e}")
-            raise
+                docs = []
+                for chunk_content, (line_start, line_end), embedding in zip(chunks, line_ranges, embeddings):
+                    docs.append({
+                        "user_id": user_id,
+                        "project_name": project_name,
+                        "file_path": file_path,
+                        "content_hash": content_hash,
+                        "content_type": "document",
+                        "language": None,
+                        "class_name": None,
+                        "function_name": None,
+                        "code_content": chunk_content,
+                        "code_embedding": embedding,
+                        "line_start": line_start,
+                        "line_end": line_end,
+                    })
+            
+                await self._bulk_index(docs)
+                chunk_count = len(chunks)
+                print(f"Successfully indexed document {file_path} ({chunk_count} chunks)")
+            
+            except Exception as e:
+                print(f"Failed to index document {file_path}: {e}")
+                await self._remove_partial_index(user_id, project_name, file_path, content_hash)
+                raise
     
-    def index_file(self, user_id: str, project_name: str, file_path: str, file_bytes: bytes):
+    @staticmethod
+    def is_supported_file(file_path: str) -> bool:
+        """Check whether index_file has a handler for this file type."""
+        _, ext = os.path.splitext(file_path.lower())
+        return (
+            ext in SUPPORTED_IMAGE_FORMATS
+            or DocumentService.is_supported_ext(ext)
+            or ext in SUPPORTED_CODE_LANGUAGES
+        )
+
+    async def index_file(self, user_id: str, project_name: str, file_path: str, file_obj: BinaryIO):
         """
         Smart indexing that detects file type and routes to appropriate handler.
         
@@ -272,22 +466,24 @@ class IndexingService:
             user_id: User ID
             project_name: Project name
             file_path: File path/name
-            file_bytes: Raw file bytes
+            file_obj: Binary file object (e.g. a staged upload)
         """
         _, ext = os.path.splitext(file_path.lower())
         
         # Check if it's an image
         if ext in SUPPORTED_IMAGE_FORMATS:
-            return self.index_image(user_id, project_name, file_path, file_bytes)
+            image_bytes = await asyncio.to_thread(file_obj.read)
+            return await self.index_image(user_id, project_name, file_path, image_bytes)
         
         # Check if it's a document
-        if DocumentService.is_supported(file_path):
-            return self.index_document(user_id, project_name, file_path, file_bytes)
+        if DocumentService.is_supported_ext(ext):
+            return await self.index_document(user_id, project_name, file_path, file_obj, ext=ext)
         
         # Check if it's code
         if ext in SUPPORTED_CODE_LANGUAGES:
+            file_bytes = await asyncio.to_thread(file_obj.read)
             file_content = file_bytes.decode('utf-8', errors='ignore')
-            return self.index_file_content(user_id, project_name, file_path, file_content)
+            return await self.index_file_content(user_id, project_name, file_path, file_content)
         
         # Unsupported type
         print(f"Unsupported file type for {file_path}: {ext}")
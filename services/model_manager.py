@@ -0,0 +1,69 @@
+import platform
+from functools import lru_cache
+
+from sentence_transformers import SentenceTransformer
+
+from ..core.config import MODEL_NAME, EMBEDDING_BACKEND, ONNX_MODEL_FILE, EMBEDDING_NUM_THREADS
+
+@lru_cache(maxsize=1)
+def _onnx_model_file() -> str:
+    """
+    The ONNX export to load: ONNX_MODEL_FILE if set, otherwise the int8 export suited to
+    this CPU. The AVX-512 VNNI one is only picked when the CPU has VNNI, since its
+    s8s8 kernels can saturate elsewhere; the AVX2 (quint8) one is the portable x86 choice.
+    """
+    if ONNX_MODEL_FILE:
+        return ONNX_MODEL_FILE
+    if platform.machine().lower() in ("arm64", "aarch64"):
+        return "onnx/model_qint8_arm64.onnx"
+    try:
+        with open("/proc/cpuinfo") as cpuinfo:
+            has_vnni = "avx512_vnni" in cpuinfo.read()
+    except OSError:  # Not Linux: don't assume VNNI
+        has_vnni = False
+    return "onnx/model_qint8_avx512_vnni.onnx" if has_vnni else "onnx/model_quint8_avx2.onnx"
+
+def _load_onnx_model():
+    """Loads the int8-quantized ONNX export of the model, run by ONNX Runtime."""
+    import onnxruntime as ort
+
+    session_options = ort.SessionOptions()
+    session_options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    session_options.intra_op_num_threads = EMBEDDING_NUM_THREADS
+
+    return SentenceTransformer(
+        MODEL_NAME,
+        backend="onnx",
+        model_kwargs={
+            "file_name": _onnx_model_file(),
+            "provider": "CPUExecutionProvider",
+            "session_options": session_options,
+        },
+    )
+
+@lru_cache(maxsize=1)
+def get_model():
+    """
+    Returns the process-wide SentenceTransformer instance.
+    The weights are loaded once and shared by every service.
+    Uses ONNX Runtime when configured, falling back to PyTorch if it is unavailable.
+    """
+    if EMBEDDING_BACKEND == "onnx":
+        print(f"Loading embedding model '{MODEL_NAME}' with ONNX Runtime ({_onnx_model_file()})...")
+        try:
+            return _load_onnx_model()
+        except Exception as e:
+            print(f"Failed to load ONNX model, falling back to PyTorch: {e}")
+
+    print(f"Loading embedding model '{MODEL_NAME}'...")
+    return SentenceTransformer(MODEL_NAME)
+
+def get_model_identity() -> str:
+    """
+    Identifies the embedding space of get_model()'s vectors: model name, and the backend
+    (and ONNX file) actually loaded, since a failed ONNX load falls back to PyTorch.
+    """
+    backend = getattr(get_model(), "backend", "torch")
+    if backend == "onnx":
+        return f"{MODEL_NAME}:onnx:{_onnx_model_file()}"
+    return f"{MODEL_NAME}:{backend}"
@@ -1,24 +1,199 @@
-from elasticsearch import Elasticsearch
-from sentence_transformers import SentenceTransformer
+import asyncio
+import threading
+
 import numpy as np
+from cachetools import TTLCache
+
+try:
+    import simsimd  # Optional: hand-written SIMD kernels for the fallback ranking
+except ImportError:
+    simsimd = None
 
-from ..core.config import ES_HOST, ES_INDEX, ES_API_KEY, MODEL_NAME
+from ..core.config import ES_INDEX, ES_VECTOR_INDEX_TYPE, SEARCH_MANUAL_RERANK_FALLBACK
+from .es_manager import get_es_client
+from .model_manager import get_model
 
 # Minimum similarity threshold (cosine similarity: -1 to 1)
 # Results below this threshold are considered not relevant
 MIN_SIMILARITY_THRESHOLD = 0.1  # Adjust this value based on your needs
 
-def search(user_id: str, query_string: str, project_name: str = None, top_k: int = 5):
+# Candidates examined per shard by the kNN search
+KNN_NUM_CANDIDATES = 100
+
+# With 1-bit (bbq) vectors, the binary pass keeps this many times k candidates,
+# which Elasticsearch then rescores with the float vectors
+KNN_RESCORE_OVERSAMPLE = 3
+
+# Fields returned for each hit (the embedding itself is never sent back)
+SOURCE_FIELDS = ["file_path", "code_content", "line_start", "line_end", "language", "user_id", "project_name"]
+
+# Queries whose embedding is at least this similar to a recent query
+# of the same user, project and top_k reuse its results
+SEMANTIC_CACHE_THRESHOLD = 0.97
+
+# (user_id, project_name, top_k, query_string) -> (normalized query embedding, search results)
+_semantic_cache = TTLCache(maxsize=256, ttl=60)
+_semantic_cache_lock = threading.Lock()
+
+
+def _semantic_cache_lookup(scope: tuple, query_embedding):
+    """Returns the cached results of the closest prior query in `scope`, if it is similar enough."""
+    with _semantic_cache_lock:
+        entries = [(key, value) for key, value in _semantic_cache.items() if key[:3] == scope]
+    if not entries:
+        return None
+
+    # Embeddings are L2-normalized: one matrix-vector product gives every cosine similarity
+    cached_embeddings = np.stack([embedding for _, (embedding, _) in entries])
+    similarities = cached_embeddings @ query_embedding
+    best = int(np.argmax(similarities))
+    if similarities[best] < SEMANTIC_CACHE_THRESHOLD:
+        return None
+
+    key, (_, results) = entries[best]
+    with _semantic_cache_lock:
+        _semantic_cache.get(key)  # Mark as recently used
+    return results
+
+def is_stale_cache_key(key: tuple, user_id: str, project_name: str) -> bool:
+    """
+    Whether cached search results keyed (user_id, project_name, ...) may include this
+    project once it changes: its own searches and the user's searches across all
+    projects (project_name None).
+    """
+    return key[0] == user_id and key[1] in (project_name, None)
+
+def invalidate_semantic_cache(user_id: str, project_name: str):
+    """Drop semantic-cache entries made stale by a change to this project."""
+    with _semantic_cache_lock:
+        stale_keys = [key for key in _semantic_cache if is_stale_cache_key(key, user_id, project_name)]
+        for key in stale_keys:
+            _semantic_cache.pop(key, None)
+
+
+def _knn_score_to_similarity(score: float) -> float:
+    """
+    Converts the _score of a `dot_product` kNN hit ((1 + dot) / 2) back into the cosine similarity
+    (the dot product of the normalized embeddings).
+    """
+    return 2 * score - 1
+
+async def _knn_search(es, bool_filter, query_embedding, top_k: int):
+    """
+    Ranks documents inside Elasticsearch with its native (HNSW) kNN search.
+    The query vector is sent as floats, Elasticsearch quantizes it for the int8 graph.
+    """
+    search_body = {
+        "knn": {
+            "field": "code_embedding",
+            "query_vector": query_embedding.tolist(),
+            "k": top_k,
+            "num_candidates": max(KNN_NUM_CANDIDATES, top_k),
+            "filter": bool_filter,
+            # Raw vector similarity (cosine for normalized embeddings): sub-threshold docs are never returned
+            "similarity": MIN_SIMILARITY_THRESHOLD
+        },
+        "size": top_k,
+        "_source": SOURCE_FIELDS
+    }
+    if ES_VECTOR_INDEX_TYPE.startswith("bbq"):
+        search_body["knn"]["rescore_vector"] = {"oversample": KNN_RESCORE_OVERSAMPLE}
+    response = await es.search(index=ES_INDEX, body=search_body)
+
+    # Report cosine similarities, as the manual ranking does
+    hits = response['hits']['hits']
+    for hit in hits:
+        hit['_score'] = _knn_score_to_similarity(hit['_score'])
+
+    response['hits']['total']['value'] = len(hits)
+    response['hits']['max_score'] = hits[0]['_score'] if hits else None
+    print(f"kNN search returned {len(hits)} results (filtered by threshold {MIN_SIMILARITY_THRESHOLD})")
+    return response
+
+async def _manual_similarity_search(es, bool_filter, query_embedding, top_k: int):
+    """
+    Fetches filtered candidates with their embeddings and ranks them in Python.
+    Only used for indices whose code_embedding is not indexed for kNN search.
+    """
+    # First, get all documents matching the filter (up to a reasonable limit).
+    # Embeddings come from _source: dense_vector fields don't support docvalue_fields.
+    search_body = {
+        "size": KNN_NUM_CANDIDATES,  # Get more candidates to rank
+        "_source": SOURCE_FIELDS + ["code_embedding"],
+        "query": bool_filter
+    }
+    
+    response = await es.search(
+        index=ES_INDEX,
+        body=search_body
+    )
+    
+    # Compute similarity scores manually
+    hits = response['hits']['hits']
+    if hits:
+        # Score all candidates at once: one (N, D) @ (D,) matrix-vector product.
+        # Embeddings are L2-normalized, so the dot product is the cosine similarity.
+        doc_embeddings = np.asarray([hit['_source']['code_embedding'] for hit in hits], dtype=np.float32)
+        if simsimd is not None:
+            scores = np.asarray(
+                simsimd.cdist(query_embedding[None, :], doc_embeddings, metric="dot")
+            ).ravel()
+        else:
+            scores = doc_embeddings @ query_embedding
+        
+        # Keep scores above the threshold, then select the top_k in O(N)
+        # and only sort those k (descending)
+        candidates = np.flatnonzero(scores >= MIN_SIMILARITY_THRESHOLD)
+        k = min(top_k, candidates.size)
+        if k > 0:
+            top = candidates[np.argpartition(-scores[candidates], k - 1)[:k]]
+            top_indices = top[np.argsort(-scores[top])].tolist()
+        else:
+            top_indices = []
+        
+        # Reconstruct response with scored results
+        response['hits']['hits'] = []
+        for i in top_indices:
+            hit = hits[i]
+            hit['_score'] = float(scores[i])
+            # Remove embedding from source to reduce response size
+            del hit['_source']['code_embedding']
+            response['hits']['hits'].append(hit)
+        
+        response['hits']['total']['value'] = len(top_indices)
+        response['hits']['max_score'] = float(scores[top_indices[0]]) if top_indices else None
+        
+        print(f"Manual similarity search returned {len(top_indices)} results (filtered by threshold {MIN_SIMILARITY_THRESHOLD})")
+    else:
+        print("No documents found matching the filter")
+
+    return response
+
+async def search(user_id: str, query_string: str, project_name: str = None, top_k: int = 5):
     """
     Performs a multi-tiered search for a specific user and optional project.
-    Tries kNN first, then falls back to text.
+    Tries kNN first, then manual similarity ranking, then falls back to text.
+    Returns (results, from_semantic_cache); results is None if every stage failed.
     """
     print(f"Searching for user '{user_id}' in project '{project_name}' with query: '{query_string}'")
 
-    es = Elasticsearch(ES_HOST, api_key=ES_API_KEY)
-    model = SentenceTransformer(MODEL_NAME)
+    es = get_es_client()
+    # The shared model is only loaded on first use; loading and encoding are CPU bound,
+    # keep them off the event loop
+    model = await asyncio.to_thread(get_model)
 
-    query_embedding = model.encode(query_string)
+    query_embedding = await asyncio.to_thread(
+        model.encode, query_string, normalize_embeddings=True, convert_to_numpy=True
+    )
+    # Pin float32 so scoring against the float32 document embeddings never upcasts
+    query_embedding = query_embedding.astype(np.float32, copy=False)
+
+    # A paraphrase of a recent query returns its results without hitting Elasticsearch
+    scope = (user_id, project_name, top_k)
+    cached_results = _semantic_cache_lookup(scope, query_embedding)
+    if cached_results is not None:
+        print("Semantic cache hit")
+        return cached_results, True
 
     # Build the base filter for user and project
     # Using 'term' for exact match on keyword fields
@@ -29,59 +204,27 @@ def search(user_id: str, query_string: str, project_name: str = None, top_k: int
 
     response = None
 
-    # --- STAGE 1: Get filtered documents and compute similarity manually ---
+    # --- STAGE 1: kNN search, ranked by Elasticsearch ---
     try:
-        print("Executing filtered search with manual similarity ranking...")
-        # First, get all documents matching the filter (up to a reasonable limit)
-        search_body = {
-            "size": 100,  # Get more candidates to rank
-            "_source": ["file_path", "code_content", "line_start", "line_end", "language", "user_id", "project_name", "code_embedding"],
-            "query": bool_filter
-        }
-        
-        response = es.search(
-            index=ES_INDEX,
-            body=search_body
-        )
-        
-        # Compute similarity scores manually
-        hits = response['hits']['hits']
-        if hits:
-            similarities = []
-            for hit in hits:
-                doc_embedding = np.array(hit['_source']['code_embedding'])
-                similarity = np.dot(query_embedding, doc_embedding) / (
-                    np.linalg.norm(query_embedding) * np.linalg.norm(doc_embedding)
-                )
-                similarities.append((hit, similarity))
-            
-            # Sort by similarity (descending) and take top_k
-            similarities.sort(key=lambda x: x[1], reverse=True)
-            
-            # Filter by minimum similarity threshold
-            filtered_results = [(hit, score) for hit, score in similarities if score >= MIN_SIMILARITY_THRESHOLD]
-            top_results = filtered_results[:top_k]
-            
-            # Reconstruct response with scored results
-            response['hits']['hits'] = []
-            for hit, score in top_results:
-                hit['_score'] = float(score)
-                # Remove embedding from source to reduce response size
-                del hit['_source']['code_embedding']
-                response['hits']['hits'].append(hit)
-            
-            response['hits']['total']['value'] = len(top_results)
-            response['hits']['max_score'] = float(top_results[0][1]) if top_results else None
-            
-            print(f"Manual similarity search returned {len(top_results)} results (filtered by threshold {MIN_SIMILARITY_THRESHOLD})")
-        else:
-            print("No documents found matching the filter")
-            
+        print("Executing kNN search...")
+        response = await _knn_search(es, bool_filter, query_embedding, top_k)
     except Exception as e:
-        print(f"Filtered search failed: {e}")
+        print(f"kNN search failed: {e}")
         response = None
 
-    # --- STAGE 2: If kNN failed, do a text-only search ---
+    # --- STAGE 2: If kNN failed (e.g. embeddings not indexed), rank candidates manually ---
+    if response is None and SEARCH_MANUAL_RERANK_FALLBACK:
+        try:
+            print("Executing filtered search with manual similarity ranking...")
+            response = await _manual_similarity_search(es, bool_filter, query_embedding, top_k)
+        except Exception as e:
+            print(f"Filtered search failed: {e}")
+            response = None
+
+    # Only vector-ranked results may be served to paraphrases of this query
+    vector_ranked = response is not None
+
+    # --- STAGE 3: If both failed, do a text-only search ---
     if response is None:
         try:
             print("Falling back to text-only search...")
@@ -96,7 +239,7 @@ def search(user_id: str, query_string: str, project_name: str = None, top_k: int
                     }
                 }
             }
-            response = es.search(
+            response = await es.search(
                 index=ES_INDEX,
                 query=text_query, # The 'query' parameter works for text-only search
                 size=top_k,
@@ -104,6 +247,9 @@ def search(user_id: str, query_string: str, project_name: str = None, top_k: int
             )
         except Exception as fallback_e:
             print(f"All search attempts failed. Final error: {fallback_e}")
-            return None
+            return None, False
 
-    return response
\ No newline at end of file
+    if vector_ranked:
+        with _semantic_cache_lock:
+            _semantic_cache[scope + (query_string,)] = (query_embedding, response)
+    return response, False
\ No newline at end of file
@@ -1,15 +1,103 @@
 """
 Vision service for generating descriptions of images using FeatherlessAI.
 """
-import base64
+import asyncio
+import multiprocessing
+import random
 import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import lru_cache
 from io import BytesIO
-from typing import Optional
+from typing import List, Optional
 
-from openai import OpenAI
+try:
+    import pybase64 as base64  # Optional: SIMD base64, same API as the stdlib module
+except ImportError:
+    import base64
+
+from openai import APIConnectionError, APIStatusError, AsyncOpenAI, InternalServerError, OpenAI, RateLimitError
 from PIL import Image
 
-from ..core.config import FEATHERLESS_API_KEY, FEATHERLESS_BASE_URL, FEATHERLESS_VISION_MODEL
+from ..core.config import FEATHERLESS_API_KEY, FEATHERLESS_BASE_URL, FEATHERLESS_VISION_MODEL, IMAGE_RESIZE_WORKERS
+
+# Default prompt for technical/code-related images
+DEFAULT_PROMPT = """Describe this image in detail. Focus on:
+- What type of content it shows (code, diagram, UI, screenshot, etc.)
+- Key elements and their purpose
+- Any text, code, or technical information visible
+- Overall context and what it represents
+
+Be specific and technical in your description."""
+
+
+@lru_cache(maxsize=1)
+def _get_resize_pool() -> ProcessPoolExecutor:
+    """
+    Process pool resizing images outside the GIL (workers start on first use).
+    Workers come from a forkserver (spawn where unavailable): forking this process,
+    which already runs ONNX Runtime and worker threads, could deadlock.
+    """
+    start_method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+    return ProcessPoolExecutor(
+        max_workers=IMAGE_RESIZE_WORKERS,
+        mp_context=multiprocessing.get_context(start_method)
+    )
+
+def shutdown_resize_pool():
+    """Stops the resize workers, if the pool was ever created."""
+    if _get_resize_pool.cache_info().currsize:
+        _get_resize_pool().shutdown()
+        _get_resize_pool.cache_clear()
+
+async def _optimize_image_in_pool(image_bytes: bytes) -> bytes:
+    """
+    Run _optimize_image in the resize pool. A worker dying (OOM, crash in native code)
+    breaks the whole pool: it is then replaced and the resize retried once, and
+    finally run in this process.
+    """
+    loop = asyncio.get_running_loop()
+    for _ in range(2):
+        pool = _get_resize_pool()
+        try:
+            return await loop.run_in_executor(pool, _optimize_image, image_bytes)
+        except BrokenProcessPool:
+            print("Image resize pool is broken, replacing it...")
+            # Another call may already have replaced it
+            if _get_resize_pool.cache_info().currsize and _get_resize_pool() is pool:
+                shutdown_resize_pool()
+    return await asyncio.to_thread(_optimize_image, image_bytes)
+
+def _optimize_image(image_bytes: bytes, max_size: int = 1024) -> bytes:
+    """
+    Optimize image size to reduce API costs while maintaining quality.
+    Resizes image if larger than max_size while preserving aspect ratio.
+    JPEGs that are already small enough are returned as is.
+    Module-level so it can run in the resize process pool.
+    """
+    img = Image.open(BytesIO(image_bytes))  # Only reads the header
+    if img.format == 'JPEG' and img.mode in ('RGB', 'L') and max(img.size) <= max_size:
+        return image_bytes
+
+    # For JPEGs, let libjpeg downscale in the DCT domain while decoding (no-op for other formats)
+    img.draft('RGB', (max_size, max_size))
+
+    # Convert to RGB if necessary (handles PNG with transparency, etc.)
+    if img.mode not in ('RGB', 'L'):
+        img = img.convert('RGB')
+
+    # Resize if needed. Very large images are first shrunk with a cheaper filter
+    # so LANCZOS only runs on an image about twice the target size
+    if max(img.size) > 2 * max_size:
+        img.thumbnail((2 * max_size, 2 * max_size), Image.Resampling.BILINEAR)
+    if max(img.size) > max_size:
+        img.thumbnail((max_size, max_size), Image.Resampling.LANCZOS)
+
+    # Save to bytes. Single-pass baseline encoding: the image is only sent to the API,
+    # tuning Huffman tables (optimize=True) would cost a second pass for a few bytes
+    output = BytesIO()
+    img.save(output, format='JPEG', quality=85, optimize=False, progressive=False, subsampling=2)
+    return output.getvalue()
 
 
 class VisionService:
@@ -18,37 +106,85 @@ class VisionService:
         if not FEATHERLESS_API_KEY:
             raise ValueError("FEATHERLESS_API_KEY not configured")
         
+        # Retries are handled by describe_image(_async), not also by the SDK
         self.client = OpenAI(
             api_key=FEATHERLESS_API_KEY,
-            base_url=FEATHERLESS_BASE_URL
+            base_url=FEATHERLESS_BASE_URL,
+            max_retries=0
+        )
+        self.async_client = AsyncOpenAI(
+            api_key=FEATHERLESS_API_KEY,
+            base_url=FEATHERLESS_BASE_URL,
+            max_retries=0
         )
         self.model = FEATHERLESS_VISION_MODEL
         self.max_retries = 3
         self.retry_delay = 2  # seconds
+        self.max_retry_after = 60  # seconds, cap on the server's Retry-After
     
     def _encode_image(self, image_bytes: bytes) -> str:
         """Encode image bytes to base64 string."""
         return base64.b64encode(image_bytes).decode('utf-8')
     
-    def _optimize_image(self, image_bytes: bytes, max_size: int = 1024) -> bytes:
-        """
-        Optimize image size to reduce API costs while maintaining quality.
-        Resizes image if larger than max_size while preserving aspect ratio.
-        """
-        img = Image.open(BytesIO(image_bytes))
+    def _build_messages(self, image_bytes: bytes, prompt: Optional[str]) -> list:
+        """Prepare the chat messages sending the (already optimized) image."""
+        # Encode to base64
+        base64_image = self._encode_image(image_bytes)
         
-        # Convert to RGB if necessary (handles PNG with transparency, etc.)
-        if img.mode not in ('RGB', 'L'):
-            img = img.convert('RGB')
+        # Default prompt for technical/code-related images
+        if not prompt:
+            prompt = DEFAULT_PROMPT
         
-        # Resize if needed
-        if max(img.size) > max_size:
-            img.thumbnail((max_size, max_size), Image.Resampling.LANCZOS)
+        return [
+            {
+                "role": "user",
+                "content": [
+                    {
+                        "type": "text",
+                        "text": prompt
+                    },
+                    {
+                        "type": "image_url",
+                        "image_url": {
+                            "url": f"data:image/jpeg;base64,{base64_image}"
+                        }
+                    }
+                ]
+            }
+        ]
+    
+    def _retry_after(self, error: Exception) -> Optional[float]:
+        """Delay requested by the server's Retry-After header, in seconds (capped), if any."""
+        if not isinstance(error, APIStatusError):
+            return None
+        try:
+            retry_after = float(error.response.headers.get("retry-after"))
+        except (TypeError, ValueError):
+            return None  # No header, or an HTTP date
+        return min(max(retry_after, 0.0), self.max_retry_after)
+    
+    def _retry_wait_time(self, error: Exception, attempt: int) -> Optional[float]:
+        """Seconds to wait before retrying after `error`, or None if it must be raised."""
+        # Retryable errors: 429, 5xx and connection failures
+        if isinstance(error, (RateLimitError, InternalServerError, APIConnectionError)):
+            if attempt < self.max_retries - 1:
+                wait_time = self._retry_after(error)
+                if wait_time is None:
+                    # Exponential backoff, with jitter so concurrent calls don't retry in lockstep
+                    wait_time = self.retry_delay * (2 ** attempt) * random.uniform(0.5, 1.5)
+                print(f"FeatherlessAI error (attempt {attempt + 1}/{self.max_retries}): {error}")
+                print(f"Retrying in {wait_time:.1f} seconds...")
+                return wait_time
         
-        # Save to bytes
-        output = BytesIO()
-        img.save(output, format='JPEG', quality=85, optimize=True)
-        return output.getvalue()
+        # Non-retryable error or final attempt
+        print(f"Failed to generate image description: {error}")
+        return None
+    
+    @staticmethod
+    def _read_description(response) -> str:
+        description = response.choices[0].message.content.strip()
+        print(f"Generated image description: {description[:100]}...")
+        return description
     
     def describe_image(
         self,
@@ -69,69 +205,72 @@ class VisionService:
         """
         # Optimize image if requested
         if optimize:
-            image_bytes = self._optimize_image(image_bytes)
-        
-        # Encode to base64
-        base64_image = self._encode_image(image_bytes)
-        
-        # Default prompt for technical/code-related images
-        if not prompt:
-            prompt = """Describe this image in detail. Focus on:
-- What type of content it shows (code, diagram, UI, screenshot, etc.)
-- Key elements and their purpose
-- Any text, code, or technical information visible
-- Overall context and what it represents
-
-Be specific and technical in your description."""
+            image_bytes = _optimize_image(image_bytes)
+        messages = self._build_messages(image_bytes, prompt)
         
         # Retry logic for handling temporary API failures
-        last_error = None
         for attempt in range(self.max_retries):
             try:
                 response = self.client.chat.completions.create(
                     model=self.model,
-                    messages=[
-                        {
-                            "role": "user",
-                            "content": [
-                                {
-                                    "type": "text",
-                                    "text": prompt
-                                },
-                                {
-                                    "type": "image_url",
-                                    "image_url": {
-                                        "url": f"data:image/jpeg;base64,{base64_image}"
-                                    }
-                                }
-                            ]
-                        }
-                    ],
+                    messages=messages,
                     max_tokens=500,
                     temperature=0.3  # Lower temperature for more consistent descriptions
                 )
-                
-                description = response.choices[0].message.content.strip()
-                print(f"Generated image description: {description[:100]}...")
-                return description
+                return self._read_description(response)
                 
             except Exception as e:
-                last_error = e
-                error_msg = str(e)
-                
-                # Check if it's a retryable error (503, 429, etc.)
-                if "503" in error_msg or "429" in error_msg or "server_error" in error_msg.lower():
-                    if attempt < self.max_retries - 1:
-                        wait_time = self.retry_delay * (2 ** attempt)  # Exponential backoff
-                        print(f"FeatherlessAI error (attempt {attempt + 1}/{self.max_retries}): {error_msg}")
-                        print(f"Retrying in {wait_time} seconds...")
-                        time.sleep(wait_time)
-                        continue
+                wait_time = self._retry_wait_time(e, attempt)
+                if wait_time is None:
+                    raise
+                time.sleep(wait_time)
+    
+    async def describe_image_async(
+        self,
+        image_bytes: bytes,
+        prompt: Optional[str] = None,
+        optimize: bool = True
+    ) -> str:
+        """
+        Async variant of describe_image: waits for the API without holding a thread.
+        Same arguments and retry policy.
+        """
+        # Resize in the process pool: other images keep resizing while this one is in flight
+        if optimize:
+            image_bytes = await _optimize_image_in_pool(image_bytes)
+        messages = self._build_messages(image_bytes, prompt)
+        
+        for attempt in range(self.max_retries):
+            try:
+                response = await self.async_client.chat.completions.create(
+                    model=self.model,
+                    messages=messages,
+                    max_tokens=500,
+                    temperature=0.3
+                )
+                return self._read_description(response)
                 
-                # Non-retryable error or final attempt
-                print(f"Failed to generate image description: {e}")
-                raise
+            except Exception as e:
+                wait_time = self._retry_wait_time(e, attempt)
+                if wait_time is None:
+                    raise
+                await asyncio.sleep(wait_time)
+    
+    async def describe_images(
+        self,
+        images: List[bytes],
+        prompt: Optional[str] = None,
+        optimize: bool = True,
+        concurrency: int = 4
+    ) -> List[str]:
+        """
+        Describe several images, with at most `concurrency` API calls in flight.
+        Descriptions are returned in the order of `images`.
+        """
+        semaphore = asyncio.Semaphore(concurrency)
+        
+        async def describe_one(image_bytes: bytes) -> str:
+            async with semaphore:
+                return await self.describe_image_async(image_bytes, prompt, optimize)
         
-        # All retries failed
-        print(f"Failed to generate image description after {self.max_retries} attempts: {last_error}")
-        raise last_error
+        return await asyncio.gather(*(describe_one(image_bytes) for image_bytes in images))
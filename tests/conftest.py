@@ -0,0 +1,10 @@
+import os
+import sys
+from pathlib import Path
+
+# Tests import the package as `backend`, like the app (uvicorn backend.main:app)
+sys.path.insert(0, str(Path(__file__).resolve().parents[2]))
+
+# core.config refuses to load without these
+os.environ.setdefault("DATABASE_URL", "sqlite://")
+os.environ.setdefault("ES_API_KEY", "test")
@@ -0,0 +1,66 @@
+import pytest
+
+from backend.services.indexing_service import CHUNK_SIZE, IndexingService
+
+# A class with a method longer than CHUNK_SIZE lines, so nodes span several chunks
+LF_SOURCE = (
+    "import os\n"
+    "\n"
+    "class Loader:\n"
+    "    def load(self, path):\n"
+    + "".join(f"        value_{i} = os.path.join(path, '{i}')\n" for i in range(CHUNK_SIZE + 5))
+    + "        return path\n"
+    "\n"
+    "def main():\n"
+    "    Loader().load('.')\n"
+)
+
+
+def _node(source: bytes, text: str):
+    """Builds the AST node dict _get_ast_nodes would return for `text`."""
+    start_byte = source.index(text.encode("utf8"))
+    end_byte = start_byte + len(text.encode("utf8"))
+    return {
+        "start_byte": start_byte,
+        "end_byte": end_byte,
+        "start_line": source[:start_byte].count(b"\n"),
+        "end_line": source[:end_byte].count(b"\n"),
+    }
+
+
+def _reference_chunks(source: bytes, node):
+    """The original chunking: split the node's text into lines and re-join CHUNK_SIZE of them with \\n."""
+    lines = source[node["start_byte"]:node["end_byte"]].decode("utf8").splitlines()
+    return [
+        ("\n".join(lines[i:i + CHUNK_SIZE]), node["start_line"] + i, node["start_line"] + i + len(lines[i:i + CHUNK_SIZE]) - 1)
+        for i in range(0, len(lines), CHUNK_SIZE)
+    ]
+
+
+def _node_texts(newline: str):
+    body = LF_SOURCE.replace("\n", newline)
+    class_text = body[body.index("class Loader:"):body.index(newline + newline + "def main")]
+    method_text = body[body.index("def load"):body.index(newline + newline + "def main")]
+    function_text = body[body.index("def main"):].rstrip(newline)
+    return body.encode("utf8"), [class_text, method_text, function_text]
+
+
+@pytest.mark.parametrize("newline", ["\n", "\r\n"], ids=["lf", "crlf"])
+def test_node_chunks_match_line_split_chunking(newline):
+    source, texts = _node_texts(newline)
+    line_offsets = IndexingService._get_line_offsets(source)
+
+    for text in texts:
+        node = _node(source, text)
+        chunks = list(IndexingService._iter_node_chunks(source, line_offsets, node))
+        assert chunks == _reference_chunks(source, node)
+
+
+def test_crlf_chunks_contain_no_carriage_returns():
+    source, texts = _node_texts("\r\n")
+    line_offsets = IndexingService._get_line_offsets(source)
+
+    node = _node(source, texts[1])
+    chunks = list(IndexingService._iter_node_chunks(source, line_offsets, node))
+    assert len(chunks) == 2
+    assert all("\r" not in content for content, _, _ in chunks)
@@ -0,0 +1,64 @@
+import copy
+import json
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+from backend.services.search_service import _manual_similarity_search
+
+FIXTURES = Path(__file__).parent / "fixtures"
+
+
+class FakeElasticsearch:
+    """Replays a recorded search response and keeps the request bodies it received."""
+
+    def __init__(self, response):
+        self.response = response
+        self.bodies = []
+
+    async def search(self, index, body):
+        self.bodies.append(body)
+        return copy.deepcopy(self.response)
+
+
+def _query_embedding(values):
+    vector = np.asarray(values, dtype=np.float32)
+    return vector / np.linalg.norm(vector)
+
+
+@pytest.fixture
+def recorded_response():
+    with open(FIXTURES / "es_manual_ranking_response.json") as f:
+        return json.load(f)
+
+
+@pytest.mark.asyncio
+async def test_manual_ranking_reads_embeddings_from_source(recorded_response):
+    es = FakeElasticsearch(recorded_response)
+    bool_filter = {"bool": {"filter": [{"term": {"user_id": "user-1"}}]}}
+
+    response = await _manual_similarity_search(es, bool_filter, _query_embedding([1, 0.2, 0.2, 0.2]), top_k=2)
+
+    # dense_vector fields can't be requested as docvalue_fields
+    body = es.bodies[0]
+    assert "docvalue_fields" not in body
+    assert "code_embedding" in body["_source"]
+
+    hits = response["hits"]["hits"]
+    assert [hit["_id"] for hit in hits] == ["doc-0", "doc-3"]
+    assert hits[0]["_score"] == pytest.approx(0.9888, abs=1e-3)
+    assert response["hits"]["total"]["value"] == 2
+    assert response["hits"]["max_score"] == hits[0]["_score"]
+    assert all("code_embedding" not in hit["_source"] for hit in hits)
+
+
+@pytest.mark.asyncio
+async def test_manual_ranking_drops_results_below_threshold(recorded_response):
+    es = FakeElasticsearch(recorded_response)
+    bool_filter = {"bool": {"filter": [{"term": {"user_id": "user-1"}}]}}
+
+    response = await _manual_similarity_search(es, bool_filter, _query_embedding([1, 0.2, 0.2, 0.2]), top_k=10)
+
+    # doc-2 points away from the query (negative cosine)
+    assert [hit["_id"] for hit in response["hits"]["hits"]] == ["doc-0", "doc-3", "doc-1"]